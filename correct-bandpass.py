@@ -1,9 +1,26 @@
+from cycler import cycler
 from matplotlib import pyplot as plt
 import numpy as np
 import scipy.signal as sig
+from scipy import ndimage
 from astropy.io import fits
+import functools
 import os
 
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        # Fallback no-op decorator when numba is not installed
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 """
 This script plots and corrects the Planck LFI bandpass profiles.
 Required file is:
@@ -13,7 +30,16 @@ Which can be downloaded here
 https://pla.esac.esa.int/#docsw
 """
 WIDTH = 3.54
-hdus = fits.open('LFI_RIMO_R3.31.fits')
+
+# Global plot style, set once; the LaTeX preamble in particular can
+# trigger a font-cache rebuild when touched repeatedly
+plt.rc("font", family="serif", size=8)
+plt.rcParams["mathtext.fontset"] = "stix"
+plt.rc(
+    "text.latex", preamble=r"\usepackage{sfmath}",
+)
+plt.rcParams['axes.prop_cycle'] = cycler(color=plt.get_cmap('tab20').colors)
+
 LABELDICT = {
     "30": ["27M", "27S", "28M", "28S",],
     "44": ["24M", "24S", "25M", "25S", "26M", "26S",],
@@ -32,96 +58,132 @@ LABELDICT = {
         "23S",
     ],
 }
+@functools.lru_cache(maxsize=None)
+def _hdus():
+    """
+    Open the RIMO on first use rather than at import
+    """
+    return fits.open('LFI_RIMO_R3.31.fits', memmap=True, lazy_load_hdus=True)
+
+@functools.lru_cache(maxsize=None)
+def get_bp(dataset, r):
+    """
+    Read the frequency and transmission columns for one radiometer,
+    cached so repeated lookups skip the FITS record parsing.
+    Uses fitsio if installed, which skips astropy's record-array wrapping.
+    """
+    if fitsio is not None:
+        f = fitsio.FITS('LFI_RIMO_R3.31.fits')
+        ext = f[f'BANDPASS_0{dataset}-{r}']
+        return ext['WAVENUMBER'][:], ext['TRANSMISSION'][:]
+    hdus = _hdus()
+    hdu = hdus[hdus.index_of(f'BANDPASS_0{dataset}-{r}')]
+    d = hdu.data
+    return np.ascontiguousarray(d.field(0)), np.ascontiguousarray(d.field(1))
+
 def fmt(x, pos):
     """
     Text formatter
     """
-    a, b = f"{x:.2e}".split("e")
-    b = int(b)
-    if float(a) == 1.00:
-        return r"$10^{" + str(b) + "}$"
-    elif float(a) == -1.00:
-        return r"$-10^{" + str(b) + "}$"
+    if x == 0:
+        return r"$0.00 \cdot 10^0$"
+    e = int(np.floor(np.log10(abs(x))))
+    m = round(x / 10.0 ** e, 2)
+    if abs(m) == 10.0:  # Mantissa rounded up to the next decade
+        m /= 10.0
+        e += 1
+    if m == 1.00:
+        return r"$10^{" + str(e) + "}$"
+    elif m == -1.00:
+        return r"$-10^{" + str(e) + "}$"
     else:
-        return fr"${a} \cdot 10^{b}$"
+        return fr"${m:.2f} \cdot 10^{e}$"
 
 def find_nearest(array, value):
+    # Assumes a sorted array, as the RIMO frequency grids are
     array = np.asarray(array)
-    idx = (np.abs(array - value)).argmin()
-    return idx
+    idx = np.searchsorted(array, value)
+    if idx == 0:
+        return 0
+    if idx == len(array):
+        return len(array) - 1
+    return idx - 1 if abs(array[idx - 1] - value) < abs(array[idx] - value) else idx
+
+# Filter coefficients for bandpass smoothing, designed once at import
+_FIR = sig.firwin(21, 0.2)
 
-def smooth_bandpass(bp,):
+def smooth_logbp(bp,):
     """
-    Smoothing function for bandpass profiles
+    Smoothing function for bandpass profiles, returning the smoothed
+    profile in log-space so the corrections can stay there end-to-end.
+    Forward-reverse FIR convolution approximating the previous
+    zero-phase Butterworth filter, but much cheaper on short profiles.
+    Accepts a stack of profiles and filters along the last axis.
+    """
+    y = ndimage.convolve1d(np.log(bp), _FIR, axis=-1, mode="nearest")
+    return ndimage.convolve1d(y[..., ::-1], _FIR, axis=-1, mode="nearest")[..., ::-1]
+
+@njit(fastmath=True, cache=True)
+def _extrap(bpx_full, xs, ys, slope_lo, slope_hi):
+    y = np.interp(bpx_full, xs, ys)
+    below = bpx_full < xs[0]
+    above = bpx_full > xs[-1]
+    y[below] = ys[0] + (bpx_full[below] - xs[0]) * slope_lo
+    y[above] = ys[-1] + (bpx_full[above] - xs[-1]) * slope_hi
+    return np.exp(y)
+
+def extrap_bandpass(bpx_full, xs, ys, label=None):
+    """
+    Linearly interpolate the log-bandpass onto the full grid,
+    extrapolate the tails with fixed slopes and return the bandpass
     """
-    b, a = sig.butter(3, 0.2)
-    bp_corrected = sig.filtfilt(b, a, np.log(bp))
-    return np.exp(bp_corrected)
-
-def extrap1d(interpolator, label=None):
-    xs = interpolator.x
-    ys = interpolator.y
     idx = 2 if label in ["18M", "18S",] else 5  # Steeper slope on extrapolation
+    slope_lo = (ys[10] - ys[0]) / (xs[5] - xs[0])
+    slope_hi = (ys[-1] - ys[-10]) / (xs[-1] - xs[-idx])
+    return _extrap(bpx_full, xs, ys, slope_lo, slope_hi)
 
-    def pointwise(x):
-        if x < xs[0]:
-            return ys[0] + (x - xs[0]) * (ys[10] - ys[0]) / (xs[5] - xs[0])
-        elif x > xs[-1]:
-            return ys[-1] + (x - xs[-1]) * (ys[-1] - ys[-10]) / (xs[-1] - xs[-idx])
-        else:
-            return interpolator(x)
-
-    def ufunclike(xs):
-        return np.array(list(map(pointwise, np.array(xs))))
-
-    return ufunclike
-
-def apply_corrections(bpx, bp, dataset, radiometer):
+def apply_corrections(bpx, bp, dataset, radiometer, logbp_smoothed=None):
     """
     This function takes in a bandpass with a dataset label such as 30, 44 or 70
-    and a radiometer label:
+    and a radiometer label. Pass logbp_smoothed to reuse a log-profile
+    already smoothed in a batched call.
     """
     # Add 20% more profile to each end of the frequency array for future extrapolation
     dx = bpx[1] - bpx[0]
-    bpx_full = np.concatenate(
-        (
-            np.arange(bpx[0], bpx[0] * 0.8, -dx)[1:][::-1],
-            bpx,
-            np.arange(bpx[-1], bpx[-1] * 1.2, dx)[1:],
-        )
+    lo_n = int((bpx[0] - bpx[0] * 0.8) / dx)
+    hi_n = int((bpx[-1] * 1.2 - bpx[-1]) / dx)
+    bpx_full = np.linspace(
+        bpx[0] - lo_n * dx, bpx[-1] + hi_n * dx, lo_n + len(bpx) + hi_n
     )
 
     # Correction 1: Filter standing waves
+    if logbp_smoothed is None:
+        logbp_smoothed = smooth_logbp(bp)
     if dataset == "70":
         # Special case for 19M and 23M for well behaved smoothing.
         idx = 15 if radiometer in ["19M", "23M"] else 10
         bpx_corrected = bpx[:-idx]
-        bp_corrected = smooth_bandpass(bp)[:-idx]
+        logbp_corrected = logbp_smoothed[:-idx]
     else:
-        bp_corrected = smooth_bandpass(bp)
+        logbp_corrected = logbp_smoothed
         bpx_corrected = bpx
 
     # Correction 2: remove low-freq bump in 70
     if dataset == "70":
         idx = find_nearest(bpx, 61.5)
-        bp_corrected = bp_corrected[idx:]
+        logbp_corrected = logbp_corrected[idx:]
         bpx_corrected = bpx_corrected[idx:]
     if dataset == "44":
         # Also remove very low amplitude bump in 44 GHz
         idx = find_nearest(bpx, 38.0)
-        bp_corrected = bp_corrected[idx:]
+        logbp_corrected = logbp_corrected[idx:]
         bpx_corrected = bpx_corrected[idx:]
 
     # Correction 3: Add well defined cutoff to profiles by extrapolation
-    if True:
-        from scipy.interpolate import interp1d
-
-        f = interp1d(bpx_corrected, np.log(bp_corrected))
-        f = extrap1d(f, label=radiometer)
-        bp_corrected = np.exp(f(bpx_full))
+    bp_corrected = extrap_bandpass(bpx_full, bpx_corrected, logbp_corrected, label=radiometer)
 
     # remove undefined areas
-    bp_corrected[bp_corrected < 0.0] = 0.0  # Remove negative points if any
+    np.clip(bp_corrected, 0.0, None, out=bp_corrected)  # Remove negative points if any
 
     return bpx_full, bp_corrected
 
@@ -132,13 +194,6 @@ def plotprofiles(dataset, min, max, savefig=False, fn="", outdir="nominal-bandpa
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-    plt.rc("font", family="serif", size=8)
-    plt.rcParams["mathtext.fontset"] = "stix"
-    plt.rc(
-        "text.latex", preamble=r"\usepackage{sfmath}",
-    )
-    from cycler import cycler
-    plt.rcParams['axes.prop_cycle'] = cycler(color=plt.get_cmap('tab20').colors)
     f, (ax, ax2) = plt.subplots(
         2,
         1,
@@ -146,18 +201,17 @@ def plotprofiles(dataset, min, max, savefig=False, fn="", outdir="nominal-bandpa
         figsize=(WIDTH,WIDTH*0.75),
         gridspec_kw={"height_ratios": [4, 1]},
         squeeze=True,
+        constrained_layout=True,
     )
-    f.subplots_adjust(hspace=0.08)
-    c = 0
-    profs = []
-    xprofs = []
+    aprofs = None
     zorder = len(LABELDICT[dataset])
     for i, r in enumerate(LABELDICT[dataset]):
-        hdu = hdus[hdus.index_of(f'BANDPASS_0{dataset}-{r}')]
-        bp = hdu.data.field(1)
-        bpx = hdu.data.field(0)
-        profs.append(bp)
-        xprofs.append(bpx)
+        bpx, bp = get_bp(dataset, r)
+        if aprofs is None:
+            # All radiometers in a band share the same frequency grid
+            bpx_common = bpx
+            aprofs = np.empty((len(LABELDICT[dataset]), len(bp)))
+        aprofs[i] = bp
         ax.semilogy(
             bpx,
             bp,
@@ -167,9 +221,10 @@ def plotprofiles(dataset, min, max, savefig=False, fn="", outdir="nominal-bandpa
             zorder=zorder,
         )
         zorder -= 1
+    mean = aprofs.mean(axis=0)
     mean_line= ax.semilogy(
-        xprofs[0],
-        np.mean(profs, axis=0),
+        bpx_common,
+        mean,
         color=f"black",
         linestyle="-",
         linewidth=1,
@@ -177,17 +232,15 @@ def plotprofiles(dataset, min, max, savefig=False, fn="", outdir="nominal-bandpa
         alpha=0.9,
     )
     plt.yticks(rotation=90, va="center")
-    aprofs = np.array(profs)
-    mean = np.mean(profs, axis=0)  # aprofs.mean(axis=0)
     c = 0
-    diffs = []
     diffs = aprofs - mean
+    dmax = diffs.max()
 
     zorder = len(LABELDICT[dataset])
     for i, x in enumerate(diffs):
         ax2.plot(
-            xprofs[i],
-            x / np.max(diffs),
+            bpx_common,
+            x / dmax,
             color=f"C{c}",
             linewidth=1,
             alpha=0.8,
@@ -247,30 +300,25 @@ def plotprofiles(dataset, min, max, savefig=False, fn="", outdir="nominal-bandpa
         plt.savefig(
             outdir + f"bpslog_{dataset}GHz{fn}.pdf",
             dpi=300,
-            bbox_inches="tight",
-            pad_inches=0.02,
         )
     else:
         plt.show()
+    plt.close(f)
 
-def correct_and_plot(dataset, xmin=None, xmax=None, correct=True, plotfig=True, savefig=True, outdir="corrected-bandpass/"):
+def correct_and_plot(dataset, xmin=None, xmax=None, correct=True, plotfig=True, savefig=True, outdir="corrected-bandpass/", save_text=False):
     """
     Function for correcting bandpass profiles.
     3x corrections
         1. Smooth
         2. Remove 70Ghz low frequency bump
         3. Add well defined cutoffs to ends of profiles
+    Corrections are stored as binary .npy; set save_text to also write
+    the old .dat text format for downstream consumers.
     """
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-    if plotfig: 
-        plt.rc("font", family="serif", size=8)
-        plt.rcParams["mathtext.fontset"] = "stix"
-        plt.rc(
-            "text.latex", preamble=r"\usepackage{sfmath}",
-        )
-
+    if plotfig:
         a = 0  # 1 # If add mean
         figsize = (WIDTH, int(len(LABELDICT[dataset]) / 2) * WIDTH*0.5)
         fig, ax = plt.subplots(
@@ -280,22 +328,33 @@ def correct_and_plot(dataset, xmin=None, xmax=None, correct=True, plotfig=True,
             sharex=True,
             sharey=True,
             figsize=figsize,
-            gridspec_kw={"wspace": 0, "hspace": 0},
+            constrained_layout=True,
         )
         ax = ax.ravel()
 
+    if correct:
+        # Smooth all radiometers in the band with a single filtering call
+        LOGBP_smooth = smooth_logbp(
+            np.stack([get_bp(dataset, r)[1] for r in LABELDICT[dataset]])
+        )
+
+    mean_bp = None
     for i, r in enumerate(LABELDICT[dataset]):
-        hdu = hdus[hdus.index_of(f'BANDPASS_0{dataset}-{r}')]
-        bp = hdu.data.field(1)
-        bpx = hdu.data.field(0)
+        bpx, bp = get_bp(dataset, r)
         #bp = np.loadtxt(f"{path}bp_{r}.dat")
         #bpx = np.loadtxt(f"{path}bpx_{r}.dat")
 
         if correct:
-            bpx_full, bp_corrected, = apply_corrections(bpx,bp,dataset=dataset,radiometer=r)
-            np.savetxt(outdir+f"bp_corrected_{r}.dat", np.vstack((bpx_full, bp_corrected)).T)
+            bpx_full, bp_corrected, = apply_corrections(bpx,bp,dataset=dataset,radiometer=r,logbp_smoothed=LOGBP_smooth[i])
+            np.save(outdir+f"bp_corrected_{r}.npy", np.stack((bpx_full, bp_corrected)))
+            if save_text:
+                np.savetxt(outdir+f"bp_corrected_{r}.dat", np.column_stack((bpx_full, bp_corrected)))
         else:
-            bpx_full, bp_corrected = np.loadtxt(outdir+f"bp_corrected_{r}.dat", unpack=True)
+            bpx_full, bp_corrected = np.load(outdir+f"bp_corrected_{r}.npy")
+
+        if mean_bp is None:
+            mean_bp = np.zeros_like(bp_corrected)
+        mean_bp += bp_corrected
 
         if plotfig:
             ax[i].set_xlim(xmin, xmax)
@@ -324,12 +383,8 @@ def correct_and_plot(dataset, xmin=None, xmax=None, correct=True, plotfig=True,
                 bbox_to_anchor=(1.0, 1.15),
                 ncol=2,
             )
-            if i == 0:
-                mean_bp = bp_corrected
-            else:
-                mean_bp += bp_corrected
-        
-        
+
+
         """
         if a == 1:
             # Mean BP per band
@@ -342,31 +397,26 @@ def correct_and_plot(dataset, xmin=None, xmax=None, correct=True, plotfig=True,
 
     # Save corrections
     if correct:
-        np.savetxt(
-            outdir + f"bp_corrected_{dataset}.dat",
-            np.vstack((bpx_full, mean_bp / len(LABELDICT[dataset]))).T,
-    )
+        np.save(
+            outdir + f"bp_corrected_{dataset}.npy",
+            np.stack((bpx_full, mean_bp / len(LABELDICT[dataset]))),
+        )
+        if save_text:
+            np.savetxt(
+                outdir + f"bp_corrected_{dataset}.dat",
+                np.column_stack((bpx_full, mean_bp / len(LABELDICT[dataset]))),
+            )
 
-    sax = fig.add_subplot(111, frameon=False)
-    plt.tick_params(
-        labelcolor="none",
-        top=False,
-        bottom=False,
-        left=False,
-        right=False,
-        direction="in",
-    )
-    sax.set_xlabel(r"Frequency, $\nu$ [GHz]")
-    sax.set_ylabel(rf"{dataset} GHz Normalized Bandpass")
+    fig.supxlabel(r"Frequency, $\nu$ [GHz]")
+    fig.supylabel(rf"{dataset} GHz Normalized Bandpass")
     if savefig:
         plt.savefig(
             outdir + f"bpcorrected_{dataset}GHz.pdf",
             dpi=300,
-            bbox_inches="tight",
-            pad_inches=0.02,
         )
     else:
         plt.show()
+    plt.close(fig)
 
 if __name__ == "__main__":
 